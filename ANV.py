@@ -1,6 +1,198 @@
 # From the paper: Classification of Protein Sequences by a Novel Alignment-Free Method on Bacterial and Virus Families (2022)
 import numpy as np
-from numba import jit
+from numba import jit, prange
+
+N_FEATURES = 250  # 20 counts + 20 kesai + 20 D + 190 lower-triangle covariances
+
+
+@jit('void(int32[::1], int32[::1], int32[::1], int32[::1])', nopython=True, cache=True)
+def _count_amino_acids_numba(codes, t, starts, n):
+    """
+    Count amino acids and record their positions from pre-mapped residue codes.
+    
+    Args:
+        codes: Amino acid indices (int32 array, -1 for unmapped characters)
+        t: Output flat position array (int32, seq_len); the sorted 0-based positions
+           of amino acid i occupy t[starts[i]:starts[i] + n[i]]
+        starts: Output start offset of each amino acid's slice in t (int32, length 20)
+        n: Output amino acid counts (int32, length 20)
+    """
+    n[:] = 0
+    for i in range(codes.shape[0]):
+        char_code = codes[i]
+        if char_code != -1:
+            n[char_code] += 1
+    
+    offset = 0
+    for k in range(20):
+        starts[k] = offset
+        offset += n[k]
+    
+    # Second pass: scatter positions into each amino acid's contiguous slice
+    fill = starts.copy()
+    for i in range(codes.shape[0]):
+        char_code = codes[i]
+        if char_code != -1:
+            t[fill[char_code]] = i
+            fill[char_code] += 1
+
+
+@jit('UniTuple(float64[::1], 4)(int32[::1], int32[::1], int32[::1], int64)', nopython=True, cache=True)
+def _compute_statistics_numba(t, starts, n, seq_len):
+    """
+    Compute theta, sigma, D, kesai from the run lengths between amino acid positions.
+    
+    The cumulative count of amino acid i equals k on the run between its (k-1)-th and
+    k-th positions, so its sum and sum of squares are sums of k * run and k^2 * run
+    over n[i] runs.
+    
+    Args:
+        t: Flat position array (int32, seq_len)
+        starts: Start offset of each amino acid's positions in t
+        n: Amino acid counts
+        seq_len: Sequence length
+    
+    Returns:
+        tuple: (theta, sigma, D, kesai) - statistical measures
+    """
+    theta = np.zeros(20)
+    sigma = np.zeros(20)
+    D = np.zeros(20)
+    kesai = np.zeros(20)
+    
+    for i in range(20):
+        s = 0.0
+        sq = 0.0
+        pos = t[starts[i]:starts[i] + n[i]]
+        for k in range(n[i]):
+            run_end = pos[k + 1] if k + 1 < n[i] else seq_len
+            run = float(run_end - pos[k])
+            count = float(k + 1)
+            s += count * run
+            sq += count * count * run
+        
+        theta[i] = s / seq_len
+        sigma[i] = s
+        if n[i] > 0:
+            # Centered sum of squares via the variance identity
+            D[i] = (sq - 2 * theta[i] * s + seq_len * theta[i] * theta[i]) / (n[i] * n[i])
+            kesai[i] = s / n[i]
+    
+    return theta, sigma, D, kesai
+
+
+@jit('float64[:, ::1](int32[::1], int32[::1], float64[::1], int32[::1], int64)', nopython=True, cache=True)
+def _compute_covariance_numba(t, starts, theta, n, seq_len):
+    """
+    Compute the covariance matrix by merge-walking the sorted position lists of each pair.
+    
+    Between two consecutive positions of either amino acid both cumulative counts are
+    constant, so each pair costs O(n[i] + n[j]) instead of O(seq_len).
+    
+    Args:
+        t: Flat position array (int32, seq_len)
+        starts: Start offset of each amino acid's positions in t
+        theta: Mean values for each amino acid
+        n: Amino acid counts
+        seq_len: Sequence length
+    
+    Returns:
+        numpy.ndarray: 20x20 covariance matrix
+    """
+    cov = np.zeros((20, 20))
+    
+    for i in range(20):
+        if n[i] > 0:
+            pos_i = t[starts[i]:starts[i] + n[i]]
+            for j in range(i):  # Only lower triangle (i > j)
+                if n[j] > 0:
+                    pos_j = t[starts[j]:starts[j] + n[j]]
+                    a = 0
+                    b = 0
+                    prev = 0
+                    cross = 0.0
+                    while a < n[i] or b < n[j]:
+                        if b >= n[j] or (a < n[i] and pos_i[a] < pos_j[b]):
+                            pos = pos_i[a]
+                            cross += float(a) * float(b) * (pos - prev)
+                            a += 1
+                        else:
+                            pos = pos_j[b]
+                            cross += float(a) * float(b) * (pos - prev)
+                            b += 1
+                        prev = pos
+                    cross += float(a) * float(b) * (seq_len - prev)
+                    
+                    # Centered cross product: sum(miu_i * miu_j) - L * theta_i * theta_j
+                    cov[i, j] = (cross - seq_len * theta[i] * theta[j]) / (n[i] * n[j])
+    
+    return cov
+
+
+@jit(['void(int32[::1], float64[::1], float64[::1], float64[:, ::1], float64[:, ::1], int64)',
+      'void(int32[::1], float64[::1], float64[::1], float64[:, ::1], float32[:, ::1], int64)'], nopython=True, cache=True)
+def _build_feature_vector_numba(n, kesai, D, cov, feature1, m):
+    """
+    Build feature vector efficiently.
+    
+    Args:
+        n: Amino acid counts
+        kesai: Sigma/n ratios
+        D: D statistics
+        cov: Covariance matrix
+        feature1: Feature vector array
+        m: Index for current sequence
+    """
+    # Direct assignment to avoid function calls
+    for i in range(20):
+        feature1[m, i] = n[i]
+    
+    for i in range(20):
+        feature1[m, 20 + i] = kesai[i]
+    
+    for i in range(20):
+        feature1[m, 40 + i] = D[i]
+    
+    mm = 0
+    for i in range(20):
+        for j in range(i):  # Only lower triangle
+            feature1[m, 60 + mm] = cov[i, j]
+            mm += 1
+
+
+@jit(['void(int32[::1], int64[::1], float64[:, ::1])', 'void(int32[::1], int64[::1], float32[:, ::1])'],
+     nopython=True, parallel=True, cache=True)
+def _batch_process_numba(codes, offsets, feature1):
+    """
+    Run the natural vector pipeline for a batch of sequences in parallel.
+    
+    Args:
+        codes: Concatenated amino acid indices of all sequences (int32)
+        offsets: Sequence boundaries in codes, length num_seqs + 1
+        feature1: Output feature matrix (num_seqs x 250, float64 or float32; the statistics
+            are always computed in float64)
+    """
+    for m in prange(offsets.shape[0] - 1):
+        seq_codes = codes[offsets[m]:offsets[m + 1]]
+        seq_len = seq_codes.shape[0]
+        
+        # Per-sequence workspace, allocated inside the loop body so each thread owns its own
+        t = np.empty(seq_len, dtype=np.int32)
+        starts = np.empty(20, dtype=np.int32)
+        n = np.empty(20, dtype=np.int32)
+        
+        # Step 1: Count amino acids and positions
+        _count_amino_acids_numba(seq_codes, t, starts, n)
+        
+        # Step 2: Compute statistics from run lengths, without materializing miu
+        theta, sigma, D, kesai = _compute_statistics_numba(t, starts, n, seq_len)
+        
+        # Step 3: Compute covariance
+        cov = _compute_covariance_numba(t, starts, theta, n, seq_len)
+        
+        # Step 4: Build feature vector
+        _build_feature_vector_numba(n, kesai, D, cov, feature1, m)
+
 
 class AANaturalVector:
     """
@@ -8,16 +200,20 @@ class AANaturalVector:
     
     This class provides methods to convert amino acid sequences into feature vectors by:
     - Counting amino acid frequencies and positions
-    - Computing cumulative distributions
-    - Calculating statistical measures (theta, sigma, D, kesai)
-    - Computing covariance matrices
+    - Calculating statistical measures (theta, sigma, D, kesai) of the cumulative
+      distributions directly from the run lengths between positions
+    - Computing covariance matrices by merging position lists
     - Building final feature vectors
-    """
     
+    The numerical work runs in the module-level Numba kernels; seqs2matrix processes
+    many sequences at once across all cores.
+    """
+
     def __init__(self):
         """Initialize the analyzer with pre-computed amino acid mapping."""
         self.aa_mapping = self._create_aa_mapping()
-        
+        self.n_features = N_FEATURES
+
     def _create_aa_mapping(self):
         """
         Create a fast mapping from character codes to amino acid indices.
@@ -31,213 +227,93 @@ class AANaturalVector:
             mapping[ord(aa)] = idx
         return mapping
 
-    @staticmethod
-    @jit(nopython=True)
-    def _count_amino_acids_numba(seq, aa_mapping, seq_len):
-        """
-        Count amino acids and record positions using pre-computed mapping.
-        
-        Args:
-            seq: Amino acid sequence string
-            aa_mapping: Pre-computed character-to-index mapping
-            seq_len: Length of the sequence
-            
-        Returns:
-            tuple: (miu, t, n) - position matrices and counts
-        """
-        miu = np.zeros((20, seq_len))
-        t = np.zeros((20, seq_len), dtype=np.int32)
-        n = np.zeros(20, dtype=np.int32)
-        
-        for i in range(seq_len):
-            char_code = aa_mapping[ord(seq[i])]
-            if char_code != -1:
-                n[char_code] += 1
-                t[char_code, n[char_code] - 1] = i + 1  # 1-based indexing
-                miu[char_code, i] = 1
-        
-        return miu, t, n
-
-    @staticmethod
-    @jit(nopython=True)
-    def _compute_cumulative_counts_numba(miu, t, n, seq_len):
-        """
-        Compute cumulative counts efficiently.
-        
-        Args:
-            miu: Position indicator matrix
-            t: Position tracking matrix
-            n: Amino acid counts
-            seq_len: Sequence length
-            
-        Returns:
-            numpy.ndarray: Updated miu matrix with cumulative counts
+    def encoded2matrix(self, buf, offsets, out=None):
         """
-        for i in range(20):
-            if n[i] > 0:
-                positions = t[i, :n[i]] - 1  # Convert to 0-based indexing
-                
-                if positions[0] > 0:
-                    miu[i, :positions[0]] = 0
-                
-                for j in range(1, n[i]):
-                    start = positions[j-1]
-                    end = positions[j]
-                    miu[i, start:end] = j
-                
-                miu[i, positions[-1]:] = n[i]
-        
-        return miu
-
-    @staticmethod
-    @jit(nopython=True)
-    def _compute_statistics_numba(miu, n, seq_len):
-        """
-        Compute theta, sigma, D, kesai efficiently.
+        Convert a batch of ASCII-encoded amino acid sequences to accumulated natural vectors.
         
         Args:
-            miu: Cumulative count matrix
-            n: Amino acid counts
-            seq_len: Sequence length
-            
-        Returns:
-            tuple: (theta, sigma, D, kesai) - statistical measures
-        """
-        theta = np.sum(miu, axis=1) / seq_len
-        sigma = np.sum(miu, axis=1)
-        
-        D = np.zeros(20)
-        for i in range(20):
-            if n[i] > 0:
-                # Vectorized calculation of D
-                diff = miu[i] - theta[i]
-                D[i] = np.sum(diff * diff) / (n[i] * n[i])
-        
-        kesai = np.zeros(20)
-        for i in range(20):
-            if n[i] > 0:
-                kesai[i] = sigma[i] / n[i]
-        
-        return theta, sigma, D, kesai
-
-    @staticmethod
-    @jit(nopython=True)
-    def _compute_covariance_numba(miu, theta, n, seq_len):
-        """
-        Compute covariance matrix efficiently.
+            buf (numpy.ndarray): Concatenated sequence bytes (uint8, all < 128)
+            offsets (numpy.ndarray): Sequence boundaries in buf, length num_seqs + 1
+            out (numpy.ndarray, optional): C-contiguous float64 or float32 array of shape
+                (num_seqs, 250) to write the features into
         
-        Args:
-            miu: Cumulative count matrix
-            theta: Mean values for each amino acid
-            n: Amino acid counts
-            seq_len: Sequence length
-            
         Returns:
-            numpy.ndarray: 20x20 covariance matrix
-        """
-        cov = np.zeros((20, 20))
-        
-        for i in range(20):
-            if n[i] > 0:
-                miu_i_centered = miu[i] - theta[i]
-                denom_i = n[i]
-                
-                for j in range(i):  # Only compute lower triangle (i > j)
-                    if n[j] > 0:
-                        miu_j_centered = miu[j] - theta[j]
-                        cov_ij = np.sum(miu_i_centered * miu_j_centered) / (denom_i * n[j])
-                        cov[i, j] = cov_ij
-        
-        return cov
-
-    @staticmethod
-    @jit(nopython=True)
-    def _build_feature_vector_numba(n, kesai, D, cov, feature1, m):
-        """
-        Build feature vector efficiently.
+            numpy.ndarray: Feature matrix of shape (num_seqs, 250), out if it was given
         
-        Args:
-            n: Amino acid counts
-            kesai: Sigma/n ratios
-            D: D statistics
-            cov: Covariance matrix
-            feature1: Feature vector array
-            m: Index for current sequence
-            
-        Returns:
-            numpy.ndarray: Updated feature vector
+        Raises:
+            ValueError: If any sequence is empty, contains invalid amino acid characters
+                or out does not fit
         """
-        # Direct assignment to avoid function calls
-        for i in range(20):
-            feature1[m, i] = n[i]
+        offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        if (np.diff(offsets) <= 0).any():
+            raise ValueError("Sequence cannot be empty")
         
-        for i in range(20):
-            feature1[m, 20 + i] = kesai[i]
+        # Map residues to amino acid indices and validate with a single gather over all bytes
+        codes = self.aa_mapping[buf]
+        invalid_mask = codes == -1
+        if invalid_mask.any():
+            unique_invalid = list(np.unique(buf[invalid_mask]).tobytes().decode('ascii'))
+            raise ValueError(f"Sequence contains invalid amino acid characters: {unique_invalid}")
         
-        for i in range(20):
-            feature1[m, 40 + i] = D[i]
+        shape = (offsets.shape[0] - 1, N_FEATURES)
+        if out is None:
+            feature1 = np.empty(shape)
+        elif out.shape != shape or out.dtype not in (np.float64, np.float32) or not out.flags.c_contiguous:
+            raise ValueError(f"out must be a C-contiguous float64 or float32 array of shape {shape}")
+        else:
+            feature1 = out
         
-        mm = 0
-        for i in range(20):
-            for j in range(i):  # Only lower triangle
-                feature1[m, 60 + mm] = cov[i, j]
-                mm += 1
+        try:
+            _batch_process_numba(codes, offsets, feature1)
+        except Exception as e:
+            raise RuntimeError(f"Error processing sequences: {str(e)}")
         
         return feature1
 
-    def seq2vector(self, seq):
+    def seqs2matrix(self, seqs, out=None):
         """
-        Convert amino acid sequence to accumulated natural vector.
+        Convert a batch of amino acid sequences to accumulated natural vectors.
         
         Args:
-            seq (str): Amino acid sequence string
-            
+            seqs (list of str): Amino acid sequence strings
+            out (numpy.ndarray, optional): Output array, see encoded2matrix
+        
         Returns:
-            numpy.ndarray: Feature vector representation of the sequence
-            
+            numpy.ndarray: Feature matrix of shape (len(seqs), 250)
+        
         Raises:
-            ValueError: If sequence contains invalid amino acid characters
+            ValueError: If any sequence is empty or contains invalid amino acid characters
         """
-        # Validate sequence
-        if not isinstance(seq, str):
+        if not all(isinstance(seq, str) for seq in seqs):
             raise ValueError("Sequence must be a string")
         
-        N = len(seq)
-        if N == 0:
-            raise ValueError("Sequence cannot be empty")
+        # Non-ASCII characters can never be amino acids; ASCII guarantees the bytes index aa_mapping
+        joined = ''.join(seqs)
+        try:
+            buf = np.frombuffer(joined.encode('ascii'), dtype=np.uint8)
+        except UnicodeEncodeError:
+            unique_invalid = list({char for char in joined if ord(char) >= 128})
+            raise ValueError(f"Sequence contains invalid amino acid characters: {unique_invalid}")
         
-        # Check for valid amino acid characters
-        invalid_chars = []
-        for char in seq:
-            if ord(char) >= 128 or self.aa_mapping[ord(char)] == -1:
-                invalid_chars.append(char)
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(seq) for seq in seqs])
         
-        if invalid_chars:
-            unique_invalid = list(set(invalid_chars))
-            raise ValueError(f"Sequence contains invalid amino acid characters: {unique_invalid}")
+        return self.encoded2matrix(buf, offsets, out)
+
+    def seq2vector(self, seq, out=None):
+        """
+        Convert amino acid sequence to accumulated natural vector.
         
-        feature1 = np.zeros((1, 250)) 
+        Args:
+            seq (str): Amino acid sequence string
+            out (numpy.ndarray, optional): C-contiguous float64 or float32 array of length 250 to write into
         
-        try:
-            # Step 1: Count amino acids and positions
-            miu, t, n = self._count_amino_acids_numba(seq, self.aa_mapping, N)
-            
-            # Step 2: Compute cumulative counts
-            miu = self._compute_cumulative_counts_numba(miu, t, n, N)
-            
-            # Step 3: Compute statistics
-            theta, sigma, D, kesai = self._compute_statistics_numba(miu, n, N)
-            
-            # Step 4: Compute covariance
-            cov = self._compute_covariance_numba(miu, theta, n, N)
-            
-            # Step 5: Build feature vector
-            feature1 = self._build_feature_vector_numba(n, kesai, D, cov, feature1, 0)
-            
-        except Exception as e:
-            raise RuntimeError(f"Error processing sequence: {str(e)}")
+        Returns:
+            numpy.ndarray: Feature vector representation of the sequence (length 250)
         
-        # Remove all-zero rows
-        feature1 = feature1[~np.all(feature1 == 0, axis=1)]
-
-        return feature1
+        Raises:
+            ValueError: If sequence contains invalid amino acid characters
+        """
+        # Same kernel as the batched path, with a batch of one; empty sequences are
+        # rejected by encoded2matrix, so the row always has nonzero counts
+        return self.seqs2matrix([seq], None if out is None else out[np.newaxis])[0]
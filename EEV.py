@@ -1,6 +1,198 @@
+import functools
 import itertools
 import math
-from collections import Counter
+import types
+
+import numpy as np
+from numba import jit, prange
+
+
+@jit(nopython=True, cache=True)
+def _count_mi_windows_numba(codes, r, binom, colex_to_comb, mi_counts):
+    """
+    Count sliding windows of length r made of r distinct letters, per letter combination.
+
+    A rolling composition histogram is updated by one entering and one leaving letter
+    per step; a window of distinct letters is identified by the colexicographic rank
+    sum(binom[c_k, k]) of its sorted letter indices, mapped to the combination index.
+    """
+    comp = np.zeros(binom.shape[0], dtype=np.int32)
+    repeated = 0   # number of letters occurring more than once in the window
+    for i in range(r):
+        comp[codes[i]] += 1
+        if comp[codes[i]] == 2:
+            repeated += 1
+
+    seq_len = codes.shape[0]
+    for i in range(seq_len - r + 1):
+        if repeated == 0:
+            rank = 0
+            k = 0
+            for a in range(comp.shape[0]):
+                if comp[a] > 0:
+                    k += 1
+                    rank += binom[a, k]
+            mi_counts[colex_to_comb[rank]] += 1
+
+        if i + r < seq_len:
+            leaving = codes[i]
+            comp[leaving] -= 1
+            if comp[leaving] == 1:
+                repeated -= 1
+            entering = codes[i + r]
+            comp[entering] += 1
+            if comp[entering] == 2:
+                repeated += 1
+
+
+@jit(nopython=True, cache=True)
+def _eev_kernel(codes, A, r, comb_table, mi_comb_idx, mi_binom, mi_colex_to_comb, out):
+    """
+    Compute the EEV features of one encoded sequence into out.
+
+    out holds the E1, E2 and E3 features for every row of comb_table, followed by
+    the E4 features for every MI combination if out has room for them (zero when
+    the sequence is shorter than r).
+    """
+    seq_len = codes.shape[0]
+
+    # ---------- Single pass: count letters, positions, pairs ----------
+    number_X = np.zeros(A, dtype=np.int64)          # counts of each letter
+    position_sum = np.zeros(A, dtype=np.int64)      # sum of 1‑based positions
+    pair_counts = np.zeros((A, A), dtype=np.int64)  # adjacent pairs [first, second]
+    for i in range(seq_len):
+        c = codes[i]
+        number_X[c] += 1
+        position_sum[c] += i + 1
+        if i > 0:
+            pair_counts[codes[i - 1], c] += 1
+
+    # ---------- Per-letter entropies: H_X (E1), H_second (E2), H_rel (E3) ----------
+    total_pairs = seq_len - 1
+    all_position = seq_len * (seq_len + 1) * 0.5   # sum of positions 1..seq_len
+    entropies = np.zeros((3, A))
+    for a in range(A):
+        p = number_X[a] / seq_len
+        if p > 0:
+            entropies[0, a] = -p * math.log2(p)
+
+        # Entropy of the conditional distribution for second letter a; empty pairs
+        # are skipped by the branch, so no bias is needed to guard log2(0)
+        h = 0.0
+        for first in range(A):
+            cnt = pair_counts[first, a]
+            if cnt > 0:
+                prob = cnt / total_pairs
+                h += -prob * math.log2(prob)
+        entropies[1, a] = h
+
+        rel_p = (all_position - position_sum[a]) / all_position
+        if rel_p > 0:
+            entropies[2, a] = -rel_p * math.log2(rel_p)
+
+    # ---------- E1, E2, E3 : (sum of entropies) * (sum of counts) per combination ----------
+    n_comb = comb_table.shape[0]
+    for e in range(3):
+        for ci in range(n_comb):
+            sum_entropy = 0.0
+            sum_count = 0
+            for j in range(comb_table.shape[1]):
+                a = comb_table[ci, j]
+                if a < 0:
+                    break
+                sum_entropy += entropies[e, a]
+                sum_count += number_X[a]
+            out[e * n_comb + ci] = sum_entropy * sum_count
+
+    # ---------- E4 : mutual information for size‑r combinations ----------
+    n_mi = out.shape[0] - 3 * n_comb
+    if n_mi > 0 and r > 0:
+        mi_counts = np.zeros(n_mi, dtype=np.int64)
+        if r > 1 and r <= seq_len:
+            _count_mi_windows_numba(codes, r, mi_binom, mi_colex_to_comb, mi_counts)
+
+        for ci in range(n_mi):
+            count = mi_counts[ci]
+            if count > 0:
+                # log2(prob / prod(p_X)) = log2(prob) - sum(log2(p_X)); all letters are present
+                prob = count / seq_len
+                log_p_comb = 0.0
+                for j in range(r):
+                    log_p_comb += math.log2(number_X[mi_comb_idx[ci, j]] / seq_len)
+                out[3 * n_comb + ci] = (math.log2(prob) - log_p_comb) * prob * count
+            else:
+                out[3 * n_comb + ci] = 0.0
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _batch_eev_numba(codes, offsets, A, r, comb_table, mi_comb_idx, mi_binom, mi_colex_to_comb, out):
+    """
+    Run _eev_kernel over concatenated encoded sequences in parallel, one row of out
+    per sequence. The kernel allocates its own workspace, so iterations are independent.
+    """
+    for m in prange(offsets.shape[0] - 1):
+        _eev_kernel(codes[offsets[m]:offsets[m + 1]], A, r, comb_table, mi_comb_idx,
+                    mi_binom, mi_colex_to_comb, out[m])
+
+
+def _check_out(out, shape):
+    """Allocate the feature output, or check that a caller-provided one fits the kernel."""
+    if out is None:
+        return np.empty(shape)
+    if out.shape != shape or out.dtype not in (np.float64, np.float32) or not out.flags.c_contiguous:
+        raise ValueError(f"out must be a C-contiguous float64 or float32 array of shape {shape}")
+    return out
+
+
+@functools.lru_cache(maxsize=None)
+def _build_tables(alphabet, energy_values, mutual_information_energy):
+    """
+    Build the lookup and combination tables for an alphabet, once per setting.
+
+    Returns a tuple (char_to_idx, combinations_by_k, comb_table, mi_combinations,
+    mi_comb_idx, mi_binom, mi_colex_to_comb). The arrays and combinations_by_k are
+    read-only since they are shared between EnergyEntropy_1 instances.
+    """
+    alpha_idx = {c: i for i, c in enumerate(alphabet)}
+
+    # ASCII code -> alphabet index lookup (-1 for letters outside the alphabet)
+    char_to_idx = np.full(128, -1, dtype=np.int64)
+    for idx, letter in enumerate(alphabet):
+        char_to_idx[ord(letter)] = idx
+
+    # All k‑combinations for E1, E2, E3 (k = 1 .. energy_values-1), also as one
+    # (C, energy_values-1) table of alphabet indices padded with -1, in E1/E2/E3 order
+    combinations_by_k = {}
+    if energy_values > 1:
+        for k in range(1, energy_values):
+            combinations_by_k[k] = tuple(itertools.combinations(alphabet, k))
+    all_combinations = [comb for k in combinations_by_k for comb in combinations_by_k[k]]
+    comb_table = np.full((len(all_combinations), max(energy_values - 1, 0)), -1, dtype=np.int64)
+    for comb_pos, comb in enumerate(all_combinations):
+        comb_table[comb_pos, :len(comb)] = [alpha_idx[c] for c in comb]
+
+    # Combinations for mutual information (E4) as a (C, r) index array,
+    # plus a binomial table for colexicographic ranks and rank -> combination index
+    r = max(mutual_information_energy, 0)
+    mi_combinations = tuple(itertools.combinations(alphabet, r)) if r >= 1 else ()
+    if mi_combinations:
+        mi_comb_idx = np.array([[alpha_idx[c] for c in comb] for comb in mi_combinations],
+                               dtype=np.int64)
+    else:
+        mi_comb_idx = np.empty((0, r), dtype=np.int64)
+    mi_binom = np.array([[math.comb(a, k) for k in range(r + 1)]
+                         for a in range(len(alphabet))], dtype=np.int64)
+    mi_colex_to_comb = np.empty(len(mi_combinations), dtype=np.int64)
+    for comb_pos, letter_idx in enumerate(mi_comb_idx):   # rows are sorted
+        rank = sum(math.comb(int(a), k) for k, a in enumerate(letter_idx, start=1))
+        mi_colex_to_comb[rank] = comb_pos
+
+    for table in (char_to_idx, comb_table, mi_comb_idx, mi_binom, mi_colex_to_comb):
+        table.flags.writeable = False
+
+    return (char_to_idx, types.MappingProxyType(combinations_by_k), comb_table, mi_combinations,
+            mi_comb_idx, mi_binom, mi_colex_to_comb)
+
 
 class EnergyEntropy_1:
     def __init__(self, data_type="DNA", energy_values=2, mutual_information_energy=2):
@@ -15,21 +207,13 @@ class EnergyEntropy_1:
 
         # Alphabet for the given data type
         self.alphabet = self._get_data_type(data_type)
+        self.A = len(self.alphabet)
 
-        # Precompute all k‑combinations for E1, E2, E3 (k = 1 .. energy_values-1)
-        self.combinations_by_k = {}
-        if self.energy_values > 1:
-            for k in range(1, self.energy_values):
-                self.combinations_by_k[k] = list(itertools.combinations(self.alphabet, k))
-
-        # Precompute combinations and a fast lookup set for mutual information (E4)
-        if self.mutual_information_energy >= 1:
-            self.mi_combinations = list(itertools.combinations(
-                self.alphabet, self.mutual_information_energy))
-            self.mi_combinations_set = {"".join(sorted(c)) for c in self.mi_combinations}
-        else:
-            self.mi_combinations = []
-            self.mi_combinations_set = set()
+        # Lookup and combination tables are shared by all instances with the same settings
+        (self.char_to_idx, self.combinations_by_k, self.comb_table, self.mi_combinations,
+         self.mi_comb_idx, self.mi_binom, self.mi_colex_to_comb) = _build_tables(
+            self.alphabet, self.energy_values, self.mutual_information_energy)
+        self.n_features = 3 * self.comb_table.shape[0] + len(self.mi_combinations)  # width of encoded2matrix rows
 
     def _get_data_type(self, data_type):
         """Return the alphabet string for the given data type."""
@@ -40,119 +224,69 @@ class EnergyEntropy_1:
         }
         return data_type_dict.get(data_type.lower())
 
-    def _compute_kcomb_features(self, entropy_dict, count_dict, k):
+    def _map_bytes(self, byte_view):
+        """Map ASCII bytes to alphabet indices, raising ValueError on letters outside the alphabet."""
+        codes = self.char_to_idx[byte_view]
+        invalid_mask = codes == -1
+        if invalid_mask.any():
+            invalid = list(np.unique(byte_view[invalid_mask]).tobytes().decode('ascii'))
+            raise ValueError(f"Sequence contains letters outside the alphabet: {invalid}")
+        return codes
+
+    def _encode(self, seq):
+        """Map a sequence to alphabet indices, raising ValueError on letters outside the alphabet."""
+        try:
+            byte_view = np.frombuffer(seq.encode('ascii'), dtype=np.uint8)
+        except UnicodeEncodeError:
+            invalid = sorted({ch for ch in seq if ord(ch) >= 128})
+            raise ValueError(f"Sequence contains letters outside the alphabet: {invalid}")
+        return self._map_bytes(byte_view)
+
+    def encoded2matrix(self, buf, offsets, out=None):
         """
-        For all k‑combinations of the alphabet, compute:
-            (sum of entropy_dict[letter]) * (sum of count_dict[letter])
-        and return a list of these values in the order of itertools.combinations.
+        Compute the features of a batch of ASCII-encoded sequences.
+
+        buf holds the concatenated sequence bytes (uint8, all < 128) and offsets the
+        num_seqs + 1 sequence boundaries in buf. Returns a (num_seqs, n_features) matrix;
+        the E4 columns are always present and are zero for sequences shorter than r.
+        If out is given (C-contiguous float64 or float32 of that shape), the features are
+        written into it and it is returned; they are computed in float64 either way.
         """
-        result = []
-        for comb in self.combinations_by_k[k]:
-            sum_entropy = 0.0
-            sum_count = 0
-            for letter in comb:
-                sum_entropy += entropy_dict[letter]
-                sum_count += count_dict[letter]
-            result.append(sum_entropy * sum_count)
-        return result
+        offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        if (np.diff(offsets) < 2).any():
+            raise ValueError("Sequence length must be at least 2")
+
+        codes = self._map_bytes(buf)
+        out = _check_out(out, (offsets.shape[0] - 1, self.n_features))
+        _batch_eev_numba(codes, offsets, self.A, self.mutual_information_energy, self.comb_table,
+                         self.mi_comb_idx, self.mi_binom, self.mi_colex_to_comb, out)
+        return out
+
+    def seqs2matrix(self, seqs, out=None):
+        """Compute the features of a list of sequences, see encoded2matrix."""
+        joined = "".join(seqs)
+        try:
+            buf = np.frombuffer(joined.encode('ascii'), dtype=np.uint8)
+        except UnicodeEncodeError:
+            invalid = sorted({ch for ch in joined if ord(ch) >= 128})
+            raise ValueError(f"Sequence contains letters outside the alphabet: {invalid}")
+
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(seq) for seq in seqs])
+        return self.encoded2matrix(buf, offsets, out)
 
-    def seq2vector(self, seq):
+    def seq2vector(self, seq, out=None):
         seq_len = len(seq)
         if seq_len < 2:
             raise ValueError("Sequence length must be at least 2")
 
-        # ---------- Single pass: count letters, positions, pairs, MI windows ----------
-        letter_counts = Counter()          # counts of each letter
-        position_sum = {c: 0 for c in self.alphabet}   # sum of 1‑based positions
-        pair_counts = Counter()           # counts of adjacent pairs
-        mi_counts = Counter()            # counts of valid sorted MI windows
+        codes = self._encode(seq)
 
-        for i, ch in enumerate(seq, start=1):
-            letter_counts[ch] += 1
-            if ch in position_sum:
-                position_sum[ch] += i
-
-        # Adjacent pairs (length 2)
-        for i in range(seq_len - 1):
-            pair = seq[i:i+2]
-            pair_counts[pair] += 1
-
-        # Sliding windows for mutual information (length r)
+        # E1, E2, E3 for every k-combination, then E4 when the sequence holds an r-window
         r = self.mutual_information_energy
-        if r > 1 and r <= seq_len:
-            for i in range(seq_len - r + 1):
-                window = seq[i:i+r]
-                sorted_win = "".join(sorted(window))
-                if sorted_win in self.mi_combinations_set:
-                    mi_counts[sorted_win] += 1
-
-        # ---------- Precomputed values that are reused ----------
-        total_pairs = seq_len - 1
-        all_position = seq_len * (seq_len + 1) * 0.5   # sum of positions 1..seq_len
-
-        # Counts for all alphabet letters (including zero counts)
-        number_X = {c: letter_counts.get(c, 0) for c in self.alphabet}
-        p_X = {c: number_X[c] / seq_len for c in self.alphabet}
-
-        # ---------- E1 : entropy of single letters ----------
-        H_X = {c: -v * math.log2(v) if v > 0 else 0.0 for c, v in p_X.items()}
-        E1 = []
-        if self.energy_values > 1:
-            for k in range(1, self.energy_values):
-                E1.extend(self._compute_kcomb_features(H_X, number_X, k))
-
-        # ---------- E2 : conditional entropy based on pairs ----------
-        # For each second letter, compute the entropy of the conditional distribution
-        H_second = {c: 0.0 for c in self.alphabet}
-        if total_pairs > 0:
-            for pair, cnt in pair_counts.items():
-                if cnt == 0:
-                    continue
-                b = pair[1]          # second letter
-                prob = cnt / total_pairs
-                H_second[b] += -prob * math.log2(prob + 1e-10)
-
-        E2 = []
-        if self.energy_values > 1:
-            for k in range(1, self.energy_values):
-                E2.extend(self._compute_kcomb_features(H_second, number_X, k))
-
-        # ---------- E3 : entropy of relative positions ----------
-        H_rel = {}
-        for c in self.alphabet:
-            pos_sum = position_sum[c]
-            relative = all_position - pos_sum
-            rel_p = relative / all_position
-            if rel_p > 0:
-                H_rel[c] = -rel_p * math.log2(rel_p)
-            else:
-                H_rel[c] = 0.0
-
-        E3 = []
-        if self.energy_values > 1:
-            for k in range(1, self.energy_values):
-                E3.extend(self._compute_kcomb_features(H_rel, number_X, k))
-
-        # ---------- E4 : mutual information for size‑r combinations ----------
-        E4 = []
-        if self.mi_combinations and seq_len >= r:
-            # Product of marginal probabilities under independence
-            p_comb = {}
-            for comb in self.mi_combinations:
-                prod = 1.0
-                for letter in comb:
-                    prod *= p_X[letter]
-                p_comb[comb] = prod
-
-            for comb in self.mi_combinations:
-                key = "".join(sorted(comb))
-                count = mi_counts.get(key, 0)
-                if count > 0:
-                    prob = count / seq_len
-                    mi_val = math.log2(prob / p_comb[comb]) * prob * count
-                    E4.append(mi_val)
-                else:
-                    E4.append(0.0)
-
-        # ---------- Combine all features ----------
-        return [float(v) for v in E1 + E2 + E3 + E4]
+        n_mi = len(self.mi_combinations) if seq_len >= r else 0
+        out = _check_out(out, (3 * self.comb_table.shape[0] + n_mi,))
+
+        _eev_kernel(codes, self.A, r, self.comb_table, self.mi_comb_idx,
+                    self.mi_binom, self.mi_colex_to_comb, out)
+        return out
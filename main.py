@@ -1,3 +1,170 @@
+import copy
+import csv
+import functools
+import gc
+import hashlib
+import math
+import os
+import threading
+from itertools import product
+
+import numba
+import numpy as np
+from numba.np.ufunc.parallel import _launch_threads
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
+from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QLabel, QTreeView, QHeaderView, QPushButton,
+                             QVBoxLayout, QHBoxLayout, QFileDialog, QMessageBox, QCheckBox, QDialog, QComboBox,
+                             QDialogButtonBox)
+from PyQt6.QtGui import QStandardItemModel, QStandardItem
+from PyQt6.QtCore import (Qt, QAbstractTableModel, QModelIndex, QObject, QRunnable, QThreadPool, QStandardPaths,
+                          pyqtSignal)
+
+# sklearn, umap, pynndescent and the optional accelerated backends take seconds to import (and UMAP to
+# compile), so they are only imported by load_ml_modules() on the first Embed and Plot
+csr_matrix = PCA = TSNE = umap = NNDescent = cuTSNE = cuUMAP = MulticoreTSNE = None
+_HAS_CUML = False
+_ML_LOADED = False
+
+
+def load_ml_modules():
+    global csr_matrix, PCA, TSNE, umap, NNDescent, cuTSNE, cuUMAP, MulticoreTSNE, _HAS_CUML, _ML_LOADED
+    if _ML_LOADED:
+        return
+    from scipy.sparse import csr_matrix
+    try:  # Intel's drop-in sklearn acceleration, must be patched in before PCA/TSNE are imported
+        from sklearnex import patch_sklearn
+        patch_sklearn()
+    except ImportError:
+        pass
+    from sklearn.decomposition import PCA
+    from sklearn.manifold import TSNE
+    import umap
+    from pynndescent import NNDescent
+    try:  # GPU t-SNE and UMAP, only used when a CUDA device is present
+        from cuml.manifold import TSNE as cuTSNE, UMAP as cuUMAP
+        _HAS_CUML = True
+    except ImportError:
+        _HAS_CUML = False
+    try:  # OpenMP-parallel Barnes-Hut t-SNE
+        from MulticoreTSNE import MulticoreTSNE
+    except ImportError:
+        MulticoreTSNE = None
+    _ML_LOADED = True
+
+try:  # fastest stable 64-bit hash for the sequence identity, blake2b otherwise
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from EEV import EnergyEntropy_1
+from ANV import AANaturalVector
+
+
+BAD_RESIDUES = b'XBZUO'  # ambiguous or non-standard residues the embedders can't handle
+EMBEDDING_CACHE_VERSION = 1  # part of the on-disk cache file names, bump it when the embedding kernels change
+EMBEDDING_CACHE_MAX_BYTES = 1 << 30  # the least recently used embedding files are deleted beyond this
+
+
+def available_cores():
+    # cores this process may actually use: the SLURM allocation if there is one, else the CPU affinity mask
+    # (os.cpu_count() reports every core of the node, oversubscribing shared machines)
+    slurm_cpus = os.environ.get('SLURM_CPUS_PER_TASK')
+    if slurm_cpus and slurm_cpus.isdigit() and int(slurm_cpus) > 0:
+        return int(slurm_cpus)
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def prune_embedding_cache(cache_dir, keep, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+    # deletes the least recently used cache files (by mtime, cache hits touch their file) until the directory
+    # fits in max_bytes; keep is the file just written. Files another process still uses may fail to delete
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:  # deleted meanwhile
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def load_threading_layer():
+    # the fits run on a thread pool, and numba's fallback workqueue layer aborts the whole process when two
+    # threads launch parallel kernels at once: load TBB or OpenMP if either is installed, workqueue otherwise.
+    # Must run before the first parallel kernel or numba.set_num_threads, either loads the default layer. Returns
+    # the name of the loaded layer
+    numba.config.THREADING_LAYER = 'threadsafe'
+    try:
+        _launch_threads()
+    except ValueError:  # neither TBB nor OpenMP is installed
+        numba.config.THREADING_LAYER = 'default'
+        _launch_threads()
+    return numba.threading_layer()
+
+
+class GPUReducer:  # moves the embeddings to the GPU once per fit_transform and the points back
+    def __init__(self, reducer):
+        self.reducer = reducer
+
+    def fit_transform(self, X):
+        import cupy
+        return cupy.asnumpy(self.reducer.fit_transform(cupy.asarray(X)))
+
+
+class WorkerSignals(QObject):  # QRunnable is no QObject, so its signals live here
+    finished = pyqtSignal(object, object, int)  # cache key, reduced points, generation
+    failed = pyqtSignal(object, str, int)  # cache key, error message, generation
+
+
+class ResultCaches:  # everything computed from one set of loaded sequences, replaced as a whole on clear
+    def __init__(self, seq_hash=None):
+        self.seq_hash = seq_hash  # hash of the sequences the results are for
+        self.unique = None  # (distinct sequences, index of each loaded sequence among them)
+        self.emb: dict[str, np.ndarray] = {}  # embedding method -> embeddings of the distinct sequences
+        # embedding method -> why it failed, so it is tried and reported once rather than by every fit using it
+        self.emb_errors: dict[str, str] = {}
+        self.emb_errors_shown: set[str] = set()
+        self.pre: dict[str, np.ndarray] = {}  # embedding method -> first 50 principal components
+        self.reduced: dict[tuple, np.ndarray] = {}  # ((embedding, preconditioned), dim. reduction) -> 2D points
+        self.knn: dict[tuple, tuple] = {}  # (embedding, preconditioned) -> shared k-NN graph of that input
+
+
+class ReduceTask(QRunnable):  # prepares one reduction and runs its fit_transform on the thread pool
+    def __init__(self, key, prepare, generation):
+        super().__init__()
+        self.key = key
+        self.prepare = prepare  # returns (reducer, input), or None if the sequences were cleared meanwhile
+        self.generation = generation
+        self.signals = WorkerSignals()
+
+    def run(self):
+        try:
+            prepared = self.prepare()
+            if prepared is None:
+                reduced = None
+            else:
+                reducer, X = prepared
+                reduced = reducer.fit_transform(X)
+        except Exception as e:  # reported on the main thread, an exception here would only reach stderr
+            self.signals.failed.emit(self.key, str(e), self.generation)
+        else:
+            self.signals.finished.emit(self.key, reduced, self.generation)
+
+
 class ProtSeqExplorer(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -9,10 +176,12 @@ class ProtSeqExplorer(QMainWindow):
         self.prot_seq_label = QLabel("Protein Sequences")
         self.prot_plot_label = QLabel("Dimensionality Reduced Plot of Protein Sequence Embeddings")
 
-        self.model = QStandardItemModel()  # to show the protein sequences and their names
-        self.model.setHorizontalHeaderLabels(["Name", "Sequence", "Label"])
+        # to show the protein sequences and their names, only the first 10 residues and 15 label characters
+        self.model = SequenceTableModel(["Name", "Sequence", "Label"], preview_lengths=[None, 10, 15])
         self.prot_seq_tree = QTreeView()   # maybe use SQL and table later when also considering annotations
         self.prot_seq_tree.setModel(self.model)
+        self.prot_seq_tree.setUniformRowHeights(True)  # single-line rows, Qt skips measuring each one
+        self.prot_seq_tree.setRootIsDecorated(False)  # flat table, no branch indicators
         self.prot_seq_tree.header().setSectionResizeMode(0, QHeaderView.ResizeMode.ResizeToContents)
         self.prot_seq_tree.header().setSectionResizeMode(1, QHeaderView.ResizeMode.ResizeToContents)
         self.prot_seq_tree.header().setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
@@ -34,6 +203,8 @@ class ProtSeqExplorer(QMainWindow):
         #self.emb_button = QPushButton("Embed!")
         #self.plot_buttonn = QPushButton("Plot!")
         self.emb_plot_button = QPushButton("Embed and Plot!")
+        # reduce embeddings to 50 principal components before UMAP/DensMAP/TSNE
+        self.pca_precondition_checkbox = QCheckBox("PCA preconditioning")
         self.clear_button = QPushButton("Clear")
 
 
@@ -61,6 +232,7 @@ class ProtSeqExplorer(QMainWindow):
         
         self.button_col1.addWidget(self.load_seqs_button)
         self.button_col1.addWidget(self.process_seqs_button)
+        self.button_col1.addWidget(self.pca_precondition_checkbox)
         self.method_labels_col.addWidget(self.emb_method_label)
         self.method_labels_col.addWidget(self.dim_red_method_label)
         self.method_checkboxes_col.addWidget(self.emb_method_checkbox)
@@ -95,59 +267,141 @@ class ProtSeqExplorer(QMainWindow):
         self.sequences = []
         self.sequence_names = []
         self.sequences_valid = None
+        self.n_jobs = available_cores()  # cores for the embedders, the reducers and the k-NN search
+        self._fit_pool = QThreadPool.globalInstance()
+        if load_threading_layer() == 'workqueue':  # not threadsafe, the fits run one at a time
+            self._fit_pool = QThreadPool(self)
+            self._fit_pool.setMaxThreadCount(1)
+        # numba keeps the thread count per calling thread: this one covers the warmup, the tasks set their own
+        numba.set_num_threads(min(self.n_jobs, numba.config.NUMBA_NUM_THREADS))
+        self._seq_hash = None  # hash of the loaded sequences
+        # tasks hold on to the caches they were started with, so fits for cleared sequences never write into the
+        # current ones
+        self._caches = ResultCaches()
+        self._plot_grid = None  # (rows, cols, no. of plots) of the axes currently on the figure
+        self._plot_axes = []
+        self._scatters = []  # one PathCollection per axes, updated in place on re-plots
+        self._plot_slots: dict[tuple, int] = {}  # reduction cache key -> index of the axes showing it
+        self._pending_tasks: dict[tuple, QRunnable] = {}  # (reduction cache key, generation) -> running fit
+        self._reduce_generation = 0
+        # taken by the tasks only (never by the main thread) so they embed and precondition one at a time
+        self._prepare_lock = threading.Lock()
         self.eev = EnergyEntropy_1(data_type='protein')
         self.anv = AANaturalVector()
-        self.pca = PCA(n_components=2, svd_solver='covariance_eigh', n_jobs=2)
-        self.umap = umap.UMAP(n_components=2, n_jobs=4, metric='euclidean')
-        self.densmap = umap.UMAP(n_components=2, n_jobs=4, metric='euclidean', densmap=True)
-        self.tsne = TSNE(n_components=2, n_jobs=2)
+        self._warmup_embedders()
+        self.umap_n_neighbors = 15
+        self.tsne_perplexity = 30.0
+        self.umap = self.densmap = self.tsne = None  # created by _ensure_ml_loaded
+
+
+    def _ensure_ml_loaded(self):
+        # the reducers are only needed once something is plotted, so the window opens without importing them
+        if self.umap is None:
+            load_ml_modules()
+            self.umap = self._make_umap(densmap=False)
+            self.densmap = self._make_umap(densmap=True)
+            self.tsne = self._make_tsne()
+
+
+    def _warmup_embedders(self):
+        # compile (or load from the numba cache) the embedding kernels now rather than on the first plot,
+        # with the float32 output _get_embeddings writes into (each output dtype is its own specialization)
+        for embedder, seq in ((self.eev, 'AA'), (self.anv, 'A')):
+            embedder.seqs2matrix([seq], out=np.empty((1, embedder.n_features), dtype=np.float32))
+
+    def _make_pca(self, shape, n_components=2):
+        # covariance_eigh forms the D x D covariance, cheap for tall inputs with few features (same rule as
+        # sklearn's 'auto'); otherwise randomized SVD, seeded so re-plots stay deterministic
+        n_samples, n_features = shape
+        if n_features <= 1000 and n_samples >= 10 * n_features:
+            return PCA(n_components=n_components, svd_solver='covariance_eigh')
+        return PCA(n_components=n_components, svd_solver='randomized', random_state=0, n_oversamples=10)
+
+    def _make_tsne(self, n_components=2):
+        # fastest available t-SNE: cuML on a GPU -> MulticoreTSNE -> sklearn
+        # the Barnes-Hut implementations of cuML and MulticoreTSNE only embed into 2 dimensions
+        if n_components == 2:
+            if _HAS_CUML and self._has_cuda_device():
+                return cuTSNE(n_components=2, perplexity=self.tsne_perplexity)
+            if MulticoreTSNE is not None:
+                return MulticoreTSNE(n_components=2, perplexity=self.tsne_perplexity, n_jobs=self.n_jobs)
+        return TSNE(n_components=n_components, perplexity=self.tsne_perplexity, n_jobs=self.n_jobs)
+
+    def _make_umap(self, densmap: bool):
+        # cuML UMAP on a GPU, umap-learn otherwise; cuML has no DensMAP, so that always stays on umap-learn
+        if not densmap and _HAS_CUML and self._has_cuda_device():
+            return GPUReducer(cuUMAP(n_components=2, n_neighbors=self.umap_n_neighbors, metric='euclidean'))
+        return umap.UMAP(n_components=2, n_neighbors=self.umap_n_neighbors, n_jobs=self.n_jobs, metric='euclidean',
+                         densmap=densmap)
+
+    @staticmethod
+    def _has_cuda_device():
+        try:
+            import cupy
+            return cupy.cuda.runtime.getDeviceCount() > 0
+        except Exception:  # no cupy, no driver or no device
+            return False
 
 
     def open_parse_file(self):
         self.sequences = []   # all info cleared when the button is pressed, may need to put this after the filedialog
         self.sequence_names = []
         self.sequence_labels = []
+        self._seq_hash = self._hash_sequences()
         
         file_path, _ = QFileDialog.getOpenFileName(filter="Accepted file formats (*.fasta *.csv *.tsv)")
 
         if file_path.endswith(".fasta"):
             self.model.clear()
-            self.model.setHorizontalHeaderLabels(["Name", "Sequence", "Label"])
             self.parse_fasta(file_path)
         elif file_path.endswith("sv"):
             self.model.clear()
-            self.model.setHorizontalHeaderLabels(["Name", "Sequence", "Label"])
             self.parse_csv(file_path)
         else:
             return
 
+        self._seq_hash = self._hash_sequences()
         self.check_sequence_validity()
         self.change_tree_border_color()
 
         self.process_seqs_button.setEnabled(True)
         self.save_button.setEnabled(True)
-        self.emb_plot_button.setEnabled(True)
+        self.emb_plot_button.setEnabled(not self._has_pending_fits())
         self.clear_button.setEnabled(True)
 
     
+    def _hash_sequences(self):
+        # identity of the loaded sequences, one hash over all of them instead of one per string;
+        # hex so it can also name the on-disk embedding cache
+        data = b'\0'.join(seq.encode('utf-8') for seq in self.sequences)
+        if xxhash is not None:
+            return xxhash.xxh3_64(data).hexdigest()
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
     def parse_fasta(self, fasta_file_path):
-        with open(fasta_file_path, 'r') as f:
-            fasta_content = f.read()
-            
-        pattern = r'^>([^\n]+)\n(.*?)(?=^>|\Z)'
-        matches = re.findall(pattern, fasta_content, re.MULTILINE | re.DOTALL)
-        
-        headers = []
-        sequences = []
-        
-        for header, seq in matches:
+        header = None
+        chunks = []  # sequence lines of the current record, joined once at the next header
+
+        def flush():
+            if header is None:  # text before the first header is not a record
+                return
+            # Join the lines to get a single continuous string
+            seq = ''.join(chunks)
             self.sequence_names.append(header)
-            # Remove newlines from sequence to get a single continuous string
-            self.sequences.append(seq.replace('\n', ''))
+            self.sequences.append(seq)
 
-            seq_name = QStandardItem(str(header))
-            seq_show = QStandardItem(f'{seq.replace('\n', '')[:10]}...')  # only show the first 10 residues
-            self.model.appendRow([seq_name, seq_show, QStandardItem("")])  # no label
+        with open(fasta_file_path, 'r') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('>'):
+                    flush()
+                    header = line[1:].rstrip()
+                    chunks = []
+                else:
+                    chunks.append(line)
+        flush()
+
+        self.model.set_rows(self.sequence_names, self.sequences, [''] * len(self.sequences))  # no label
 
 
     def parse_csv(self, file_path):
@@ -156,57 +410,46 @@ class ProtSeqExplorer(QMainWindow):
         else:
             delimiter = '\t'
         with open(file_path, newline='') as file:
-            reader = csv.DictReader(file, delimiter=delimiter)
-            col_names = list(next(reader).keys())
-            # choose the sequence column, name column, label column
-            first_two_rows = []  # get the first two rows
-            for j, row in enumerate(reader):
-                if j < 2:
-                    first_two_rows.append(list(row.values()))
-                else:
-                    break
+            rows = list(csv.DictReader(file, delimiter=delimiter))  # read once, everything below indexes these rows
+        if not rows:
+            return
+
+        col_names = list(rows[0].keys())
+        # choose the sequence column, name column, label column
+        first_two_rows = [list(row.values()) for row in rows[:2]]  # get the first two rows
+
+        # get no. of unique values per column
+        unique_values_per_column = [len({row[col] for row in rows}) for col in col_names]
 
-            # get no. of unique values per column
-            unqiue_values_per_column = [0] * len(col_names)
-            for row in reader:
+        self.csv_tsv_col_choice(col_names, first_two_rows, unique_values_per_column)
+
+        if self.seq_col:  # a choice was made
+            for i, row in enumerate(rows):
+                seq = row[self.seq_col].strip()
+                self.sequences.append(seq)
                 
+                if self.seq_name_col == 'Use index as name':
+                    seq_name = str(i)
+                    self.sequence_names.append(seq_name)
+                else:
+                    seq_name = row[self.seq_name_col]
+                    self.sequence_names.append(row[self.seq_name_col])
                     
-            self.csv_tsv_col_choice(col_names, first_two_rows)
+                if self.seq_label_col == 'No labels':
+                    seq_label = ''
+                    self.sequence_labels.append(seq_label)
+                else:
+                    seq_label = row[self.seq_label_col]
+                    self.sequence_labels.append(row[self.seq_label_col])
 
-            if self.seq_col:  # a choice was made
-                for i, row in enumerate(reader):
-                    seq = row[self.seq_col].strip()
-                    self.sequences.append(seq)
-                    
-                    if self.seq_name_col == 'Use index as name':
-                        seq_name = i
-                        self.sequence_names.append(seq_name)
-                    else:
-                        seq_name = row[self.seq_name_col]
-                        self.sequence_names.append(row[self.seq_name_col])
-                        
-                    if self.seq_label_col == 'No labels':
-                        seq_label = ''
-                        self.sequence_labels.append(seq_label)
-                    else:
-                        seq_label = row[self.seq_label_col]
-                        self.sequence_labels.append(row[self.seq_label_col])
-                    
-                    self.model.appendRow([QStandardItem(seq_name), 
-                                          QStandardItem(f'{seq[:10]}...'), 
-                                          QStandardItem(f'{seq_label[:15]}...')])  # show first 15
-            else:
-                return
-                    
+            self.model.set_rows(self.sequence_names, self.sequences, self.sequence_labels)
 
             
     def check_sequence_validity(self):
-        bad_residues = set('XBZUO')
-        for seq in self.sequences:
-            if bad_residues.intersection(set(seq)):
-                self.sequences_valid = False
-                break
-        self.sequences_valid = True
+        # one C-level pass over the bytes of all sequences instead of a residue set per sequence:
+        # deleting the bad residues leaves the length unchanged only if there are none
+        joined = ''.join(self.sequences).encode('ascii', errors='replace')
+        self.sequences_valid = len(joined.translate(None, BAD_RESIDUES)) == len(joined)
 
         
     def change_tree_border_color(self):
@@ -241,7 +484,7 @@ class ProtSeqExplorer(QMainWindow):
         elif ret == QMessageBox.StandardButton.Cancel:
             print("Cancel clicked.")
 
-    def csv_tsv_col_choice(self, columns: list, first_two_rows):  # chooses sequence col, sequence name col, sequence label col from CSV/TSV
+    def csv_tsv_col_choice(self, columns: list, first_two_rows, unique_values_per_column):  # chooses sequence col, sequence name col, sequence label col from CSV/TSV
         dialog = QDialog(self)
         dialog.setWindowTitle("Parse CSV/TSV file")
         layout = QVBoxLayout(dialog)
@@ -251,11 +494,12 @@ class ProtSeqExplorer(QMainWindow):
         sneakpeak_tree = QTreeView()
         sneakpeak_tree.setModel(model)
         model.setHorizontalHeaderLabels(columns)
-        model.appendRow([QStandardItem(item) for item in first_two_rows[0]])
-        model.appendRow([QStandardItem(item) for item in first_two_rows[1]])
-        sneakpeak.addWidget(sneakpeak_tree)
+        for row in first_two_rows:
+            model.appendRow([QStandardItem(item) for item in row])
 
         # number of unique values for each column
+        model.appendRow([QStandardItem(f'{n_unique} unique') for n_unique in unique_values_per_column])
+        sneakpeak.addWidget(sneakpeak_tree)
         
         hbox = QHBoxLayout()
         col1 = QVBoxLayout()
@@ -293,71 +537,367 @@ class ProtSeqExplorer(QMainWindow):
             self.seq_col, self.seq_name_col, self.seq_label_col = '', '', ''
         
 
-    def embed_and_plot(self):
-        selected_embs = self.emb_method_checkbox.get_selected_values()  # list
-        selected_dim_reds = self.dim_red_method_method_checkbox.get_selected_values()  # list
+    def _get_unique(self):
+        # identical sequences get identical embeddings, so only the distinct ones are embedded and reduced;
+        # inverse maps every loaded sequence to its row (kept in first-seen order, so no sort is needed)
+        if self._caches.unique is None:
+            index = {}
+            inverse = np.fromiter((index.setdefault(seq, len(index)) for seq in self.sequences),
+                                  dtype=np.intp, count=len(self.sequences))
+            self._caches.unique = (list(index), inverse)
+        return self._caches.unique
+
+    @staticmethod
+    def _encode_sequences(caches):
+        # all distinct sequences as one ASCII byte buffer plus offsets, so the embedders run one batched pass
+        # (non-ASCII characters become '?' and are rejected by the embedders as invalid residues)
+        unique_seqs, _ = caches.unique
+        buf = np.frombuffer(''.join(unique_seqs).encode('ascii', errors='replace'), dtype=np.uint8)
+        offsets = np.zeros(len(unique_seqs) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(seq) for seq in unique_seqs])
+        return buf, offsets
+
+    def _get_embedder(self, emb_name):
         embs_mapping = {
-            'EEV': lambda seq: self.eev.seq2vector(seq),
-            'ANV': lambda seq: self.anv.seq2vector(seq),
+            'EEV': self.eev,
+            'ANV': self.anv,
                 }
+        return embs_mapping[emb_name]
+
+    @staticmethod
+    def _embedding_cache_path(caches, emb_name, embedder):
+        # per-user cache directory, the file name covers everything the embeddings depend on: the sequences,
+        # the method and its parameters, the feature count and the kernel version. None without a cache location
+        location = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.GenericCacheLocation)
+        if not location:  # unknown on this platform, don't fall back to the working directory
+            return None
+        cache_dir = os.path.join(location, 'ProtSeqExplorer')
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        params = '-'.join(f'{name}={value}' for name, value in sorted(vars(embedder).items())
+                          if isinstance(value, (str, int, float)))
+        params_hash = hashlib.blake2b(params.encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(cache_dir, f'{caches.seq_hash}_{emb_name}_{params_hash}_{embedder.n_features}'
+                                       f'_v{EMBEDDING_CACHE_VERSION}.npy')
+
+    def _get_embeddings(self, caches, emb_name):
+        # embeddings only depend on the loaded sequences, so each method is computed once per load,
+        # and kept on disk so the same sequences load them back in later sessions
+        if emb_name in caches.emb_errors:  # another fit already tried it
+            raise ValueError(caches.emb_errors[emb_name])
+        if emb_name not in caches.emb:
+            n_unique = len(caches.unique[0])
+            embedder = self._get_embedder(emb_name)
+            shape = (n_unique, embedder.n_features)  # (N_unique, D) matrix
+            try:
+                path = self._embedding_cache_path(caches, emb_name, embedder)
+            except OSError:  # no writable cache directory, the disk cache is only an optimization
+                path = None
+            if path is not None and os.path.exists(path):
+                try:
+                    # memory-mapped: pages are read as the reductions touch them, not all up front; copy-on-write
+                    # because numba-compiled code (pynndescent, UMAP) has no specializations for read-only arrays
+                    embeddings = np.load(path, mmap_mode='c')
+                    if embeddings.shape == shape and embeddings.dtype == np.float32:
+                        os.utime(path)  # recently used, pruned last
+                        caches.emb[emb_name] = embeddings
+                        return embeddings
+                except (OSError, ValueError):  # truncated or unreadable file, recompute it
+                    pass
+            # float32 halves the memory traffic of the reductions; the 2D plots don't need float64
+            # (results can differ from a float64 run below ~1e-6 relative). The kernels write straight
+            # into it, so no float64 matrix is materialized
+            embeddings = np.empty(shape, dtype=np.float32)
+            try:
+                caches.emb[emb_name] = embedder.encoded2matrix(*self._encode_sequences(caches), out=embeddings)
+            except Exception as e:  # e.g. invalid residues
+                caches.emb_errors[emb_name] = str(e)
+                raise
+            if path is not None:
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                try:
+                    with open(tmp_path, 'wb') as f:  # written aside and renamed, readers never see a partial file
+                        np.save(f, embeddings)
+                    os.replace(tmp_path, path)
+                    prune_embedding_cache(os.path.dirname(path), keep=path)
+                except OSError:  # e.g. a full disk, don't leave the partial file behind
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+        return caches.emb[emb_name]
+
+    def _input_key(self, emb_name, dim_red_name):
+        # the key that identifies the matrix a reduction is fitted on: (embedding method, preconditioned);
+        # PCA(2) always sees the raw embeddings, the neighbor-based methods optionally their first 50 components
+        # (50 components need more than 50 features and distinct sequences, smaller inputs are used as they are)
+        preconditioned = (dim_red_name != 'PCA' and self.pca_precondition_checkbox.isChecked()
+                          and min(len(self._get_unique()[0]), self._get_embedder(emb_name).n_features) > 50)
+        return emb_name, preconditioned
+
+    def _get_input(self, caches, input_key):
+        # the matrix a reduction is fitted on
+        emb_name, preconditioned = input_key
+        if not preconditioned:
+            return self._get_embeddings(caches, emb_name)
+        if emb_name not in caches.pre:
+            # the kNN distance cost scales with D, 50 components keep the neighborhoods nearly intact
+            pca = PCA(n_components=50, svd_solver='randomized', random_state=0)
+            caches.pre[emb_name] = pca.fit_transform(self._get_embeddings(caches, emb_name))
+        return caches.pre[emb_name]
+
+    def _make_reducer(self, shape, dim_red_name):
+        # PCA's solver depends on the input shape, so it is built per input
+        if dim_red_name == 'PCA':
+            return self._make_pca(shape)
         dim_red_mapping = {
-            'PCA': self.pca,#.fit_transform(array),
             'UMAP': self.umap,
             'DensMAP': self.densmap,
             'TSNE': self.tsne
                 }
+        # each fit gets its own copy, a reducer shared between two embeddings would race on its fitted state
+        return copy.deepcopy(dim_red_mapping[dim_red_name])
+
+    def _start_reductions(self, keys):
+        # fits every uncached reduction on the thread pool so the UI stays responsive; threads because the
+        # embedders and reducers release the GIL in their numba/BLAS kernels. Each result comes back through
+        # _on_reduced
+        generation = self._reduce_generation
+        missing = [key for key in keys if key not in self._caches.reduced
+                   and (key, generation) not in self._pending_tasks]  # not fitted and not already being fitted
+        if not missing:
+            return
+        self._get_unique()  # on the main thread, the tasks must not see sequences loaded meanwhile
+        caches = self._caches
+        pool = self._fit_pool
+        # split the cores between the fits that run concurrently
+        n_jobs = max(1, self.n_jobs // min(len(missing), pool.maxThreadCount()))
+        # a k-NN graph is only worth sharing between two or more fits on the same input, it then covers the
+        # largest neighborhood among them
+        templates = {'UMAP': self.umap, 'DensMAP': self.densmap, 'TSNE': self.tsne}
+        knn_sizes = {}
+        for input_key, dim_red_name in missing:
+            k = self._knn_size(templates.get(dim_red_name))
+            if k is not None:
+                knn_sizes.setdefault(input_key, []).append(k)
+        knn_k = {input_key: max(sizes) for input_key, sizes in knn_sizes.items() if len(sizes) > 1}
+        for key in missing:
+            prepare = functools.partial(self._prepare_reduction, caches, key, n_jobs, knn_k.get(key[0]), generation)
+            task = ReduceTask(key, prepare, generation)
+            task.signals.finished.connect(self._on_reduced)
+            task.signals.failed.connect(self._on_reduce_failed)
+            self._pending_tasks[(key, generation)] = task  # keeps the task and its signals alive until it reports
+            pool.start(task)
+
+    def _prepare_reduction(self, caches, key, n_jobs, knn_k, generation):
+        # runs on the worker: embeds (and preconditions) the input and sets up the reducer for it. One task at a
+        # time, the tasks share the cached inputs and the embedders and PCA are parallel themselves. A clear
+        # meanwhile swaps self._caches, this task then only fills the discarded ones
+        input_key, dim_red_name = key
+        # the main thread's cap doesn't carry over to the pool threads, so the embedders' and UMAP's numba
+        # kernels would otherwise use every NUMBA_NUM_THREADS thread
+        max_threads = numba.config.NUMBA_NUM_THREADS
+        with self._prepare_lock:
+            if generation != self._reduce_generation:  # cleared before this task got to run
+                return None
+            numba.set_num_threads(min(self.n_jobs, max_threads))  # the other tasks wait here, so use all cores
+            X = self._get_input(caches, input_key)
+            reducer = self._make_reducer(X.shape, dim_red_name)
+            if 'n_jobs' in getattr(reducer, '__dict__', {}):
+                reducer.n_jobs = n_jobs
+            prepared = self._with_shared_knn(caches, reducer, input_key, X, knn_k)
+        numba.set_num_threads(min(n_jobs, max_threads))  # the fits run concurrently, each on its share
+        return prepared
+
+    def _has_pending_fits(self):
+        # fits still running for the current sequences; those of cleared ones only finish in the background
+        return any(generation == self._reduce_generation for _, generation in self._pending_tasks)
+
+    def _on_reduced(self, key, reduced, generation):
+        self._pending_tasks.pop((key, generation), None)
+        if generation == self._reduce_generation:  # not a result for sequences that were cleared meanwhile
+            self._caches.reduced[key] = reduced
+            if key in self._plot_slots:
+                self._plot_reduced(self._plot_slots[key], reduced)
+                self.canvas.draw_idle()
+        if not self._has_pending_fits():
+            self.emb_plot_button.setEnabled(True)
+
+    def _on_reduce_failed(self, key, message, generation):
+        self._pending_tasks.pop((key, generation), None)
+        if generation == self._reduce_generation:
+            (emb_name, _), dim_red_name = key
+            if emb_name not in self._caches.emb_errors:
+                QMessageBox.warning(self, "Embed and Plot!", f"{emb_name} + {dim_red_name} failed: {message}")
+            elif emb_name not in self._caches.emb_errors_shown:  # the same for every fit on this embedding
+                self._caches.emb_errors_shown.add(emb_name)
+                QMessageBox.warning(self, "Embed and Plot!", f"{emb_name} embedding failed: {message}")
+        if not self._has_pending_fits():
+            self.emb_plot_button.setEnabled(True)
+
+    @staticmethod
+    def _knn_size(reducer):
+        # neighbors (the point itself included) a reducer reads from a shared k-NN graph: UMAP's n_neighbors,
+        # t-SNE's 3 * perplexity plus the point; None for reducers that search on their own (PCA, cuML, MulticoreTSNE)
+        if isinstance(reducer, umap.UMAP):
+            return reducer.n_neighbors
+        if isinstance(reducer, TSNE):
+            return int(3 * reducer.perplexity + 1) + 1
+        return None
+
+    def _get_knn(self, caches, input_key, X, need, build_k):
+        # one Euclidean k-NN graph per input, shared by UMAP, DensMAP and t-SNE instead of each building its own;
+        # each reducer reads the first `need` columns. A graph built earlier is reused when it has that many,
+        # a new one of build_k columns is only built when other fits share the input (build_k not None)
+        knn = caches.knn.get(input_key)
+        if knn is not None and knn[0].shape[1] >= need:
+            return knn
+        if build_k is None or X.shape[0] <= build_k:  # small inputs: the reducers' exact search is cheap
+            return None
+        index = NNDescent(X, n_neighbors=build_k, metric='euclidean', n_jobs=self.n_jobs)
+        knn_indices, knn_dists = index.neighbor_graph
+        caches.knn[input_key] = (knn_indices, knn_dists, index)
+        return caches.knn[input_key]
+
+    def _with_shared_knn(self, caches, reducer, input_key, X, knn_k):
+        # returns the reducer and its input, switched to the shared k-NN graph where the reducer accepts one
+        need = self._knn_size(reducer)
+        if need is None:
+            return reducer, X
+        knn = self._get_knn(caches, input_key, X, need, knn_k)
+        if knn is None:
+            return reducer, X
+        knn_indices, knn_dists, index = knn
+
+        if isinstance(reducer, umap.UMAP):
+            n_neighbors = reducer.n_neighbors
+            reducer.precomputed_knn = (knn_indices[:, :n_neighbors], knn_dists[:, :n_neighbors], index)
+            return reducer, X
+
+        # t-SNE takes the graph as a sparse precomputed distance matrix: its 3 * perplexity neighbors plus the
+        # point itself (first column, an explicit zero); sklearn squares Euclidean distances but not precomputed ones
+        n = X.shape[0]
+        k = need
+        dists = knn_dists[:, :k].astype(np.float64) ** 2
+        graph = csr_matrix((dists.ravel(), knn_indices[:, :k].ravel(), np.arange(0, n * k + 1, k)), shape=(n, n))
+        # init='pca' is not allowed with a precomputed metric, so pass the same PCA initialization explicitly
+        init = PCA(n_components=reducer.n_components, svd_solver='randomized').fit_transform(X)
+        init = init.astype(np.float32, copy=False) / np.std(init[:, 0]) * 1e-4
+        reducer.set_params(metric='precomputed', init=init)
+        return reducer, graph
+
+    def embed_and_plot(self):
+        selected_embs = self.emb_method_checkbox.get_selected_values()  # list
+        selected_dim_reds = self.dim_red_method_method_checkbox.get_selected_values()  # list
         if selected_embs and selected_dim_reds:
-            self.figure.clear()
-            self.canvas.draw()
+            self._ensure_ml_loaded()
+            if self._seq_hash != self._caches.seq_hash:  # other sequences than the cached results are for
+                self._clear_caches()
             combinations = list(product(selected_embs, selected_dim_reds))
             n_combinations = len(combinations)
 
             cols = min(4, n_combinations)
             rows = math.ceil(n_combinations / cols)
+            grid = (rows, cols, n_combinations)
 
-
-            if n_combinations > 1:
-                axes = self.figure.subplots(rows, cols)
-                axes = axes.flatten()
-                for i, (emb_name, dim_red_name) in enumerate(combinations):
-                    embeddings = np.array(list(map(embs_mapping[emb_name], self.sequences)))   # everytime need calculate the embedding again, maybe need to think of a way to cache
-                    reduced = dim_red_mapping[dim_red_name].fit_transform(embeddings)
-                    
-                    axes[i].scatter(reduced[:, 0], reduced[:, 1], color='blue', alpha=0.5, s=30)
-                    axes[i].set_title(f'{emb_name} + {dim_red_name}')
-                    axes[i].set_xlabel(f'{dim_red_name} 1')
-                    axes[i].set_ylabel(f'{dim_red_name} 2')
-                    axes[i].set_xticks([])
-                    axes[i].set_yticks([])
-    
-                for j in range(i + 1, len(axes)):
+            if grid != self._plot_grid:  # the layout changed, rebuild the axes
+                self.figure.clear()
+                axes = self.figure.subplots(rows, cols, squeeze=False).flatten()
+                for j in range(n_combinations, len(axes)):
                     self.figure.delaxes(axes[j])
-
-            else:
-                axes = self.figure.subplots()
-                embeddings = np.array(list(map(embs_mapping[selected_embs[0]], self.sequences)))   # everytime need calculate the embedding again, maybe need to think of a way to cache
-                reduced = dim_red_mapping[selected_dim_reds[0]].fit_transform(embeddings)
-                
-                axes.scatter(reduced[:, 0], reduced[:, 1], color='blue', alpha=0.5, s=30)
-                axes.set_title(f'{selected_embs[0]} + {selected_dim_reds[0]}')
-                axes.set_xlabel(f'{selected_dim_reds[0]} 1')
-                axes.set_ylabel(f'{selected_dim_reds[0]} 2')
-                axes.set_xticks([])
-                axes.set_yticks([])
-
-            self.canvas.draw()
+                self._plot_axes = list(axes[:n_combinations])
+                self._scatters = [ax.scatter([], [], color='blue', alpha=0.5, s=30) for ax in self._plot_axes]
+                for ax in self._plot_axes:
+                    ax.set_xticks([])
+                    ax.set_yticks([])
+                self._plot_grid = grid
+
+            # same layout as before: only the points and titles change, the axes and their artists are reused
+            self._plot_slots = {}
+            keys = []
+            for i, (ax, (emb_name, dim_red_name)) in enumerate(zip(self._plot_axes, combinations)):
+                key = (self._input_key(emb_name, dim_red_name), dim_red_name)
+                keys.append(key)
+                self._plot_slots[key] = i
+                ax.set_title(f'{emb_name} + {dim_red_name}')
+                ax.set_xlabel(f'{dim_red_name} 1')
+                ax.set_ylabel(f'{dim_red_name} 2')
+                # cached results are drawn right away, the others are emptied until their fit reports back
+                self._plot_reduced(i, self._caches.reduced.get(key))
+            self.canvas.draw_idle()
+
+            self._caches.emb_errors_shown.clear()  # a failed embedding is reported again on each click
+            self._start_reductions(keys)
+            if self._has_pending_fits():
+                self.emb_plot_button.setEnabled(False)  # until every fit has reported back
             
         
 
         else:
             QMessageBox.warning(self, "Embed and Plot!", "No embedding or dimensionality reduction method selected.")
 
+    def _plot_reduced(self, i, reduced):
+        # reduced holds one point per distinct sequence (None: not fitted yet); duplicates are expanded back
+        # so every loaded sequence is plotted
+        reduced = np.empty((0, 2)) if reduced is None else reduced[self._get_unique()[1]]
+        ax = self._plot_axes[i]
+        self._scatters[i].set_offsets(reduced)
+        ax.ignore_existing_data_limits = True  # fit the limits to the new points only
+        ax.update_datalim(reduced)
+        ax.autoscale_view()
+
     def clear(self):
         self.figure.clear()
         self.canvas.draw()
+        self._plot_grid = None
+        self._plot_slots = {}
+        self._clear_caches()
+        self.emb_plot_button.setEnabled(True)  # the fits still running are for the cleared plots
+
+    def _clear_caches(self):
+        # never waits on the tasks: the running ones keep their own caches, the ones that have not started see
+        # the new generation
+        self._reduce_generation += 1  # results of fits still running are for the cleared state
+        self._caches = ResultCaches(self._seq_hash)
                 
 
 
+class SequenceTableModel(QAbstractTableModel):  # plain columns served on demand instead of one QStandardItem per cell
+    def __init__(self, headers: list, preview_lengths: list):
+        super().__init__()
+        self.headers = headers
+        self.preview_lengths = preview_lengths  # per column, show only this many characters (None: all)
+        self.columns = [[] for _ in headers]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns[0])  # flat table, rows have no children
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if index.isValid() and role == Qt.ItemDataRole.DisplayRole:
+            value = self.columns[index.column()][index.row()]
+            n = self.preview_lengths[index.column()]
+            if n is not None and len(value) > n:
+                # previews are cut when the view asks for them, so no preview strings are stored per row
+                return f'{value[:n]}...'
+            return value
+        return None
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def set_rows(self, *columns):  # replaces all rows at once, one column list per header
+        self.beginResetModel()
+        self.columns = list(columns)
+        self.endResetModel()
+
+    def clear(self):
+        self.set_rows(*[[] for _ in self.headers])
+
+
 class MultiChoiceCheckBox(QWidget):
     def __init__(self, options: list):
         super().__init__()
@@ -372,15 +912,10 @@ class MultiChoiceCheckBox(QWidget):
             layout.addWidget(checkbox)
 
         self.setLayout(layout)
+        self._items = list(zip(self.checkboxes, options))  # texts kept on the Python side, no text() round trip
 
     def get_selected_values(self) -> list:
-        selected_values = []
-        for checkbox in self.checkboxes:
-            if checkbox.isChecked():
-                # Get the text associated with the checkbox
-                selected_values.append(checkbox.text())
-        
-        return selected_values
+        return [option for checkbox, option in self._items if checkbox.isChecked()]
 
 if __name__=='__main__':
     app = QApplication([])